@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 import collections
+import concurrent.futures
 import gzip
+import itertools
 import json
-import math
+import multiprocessing
+import operator
 import os
 from urllib.request import urlopen
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 model = {
     'mean': 1500,
 
@@ -35,18 +43,76 @@ model = {
     'gsMult': 5.9,
 }
 
-ratings = collections.defaultdict(lambda: model['mean'])
-rgs = collections.defaultdict(lambda: [])
+K = model['K']
+MEAN = model['mean']
+
+# revert_to_mean() blends each rating toward the mean by seasonRevertFactor
+REVERT_BIAS = model['seasonRevertFactor'] * MEAN
+REVERT_SCALE = 1 - model['seasonRevertFactor']
+
+# Game score change for each event type, built once from the model
+EVENT_DELTA = {
+    'STRIKEOUT': model['gamescore']['strikeouts'] + model['gamescore']['outs'],
+    'CAUGHT_STEALING': model['gamescore']['outs'],
+    'OUT': model['gamescore']['outs'],
+    'WALK': model['gamescore']['walks'] + model['gamescore']['hits'],
+    'SINGLE': model['gamescore']['hits'],
+    'DOUBLE': model['gamescore']['hits'],
+    'TRIPLE': model['gamescore']['hits'],
+    'FIELDERS_CHOICE': model['gamescore']['outs'] + model['gamescore']['hits'],
+    'HOME_RUN': model['gamescore']['homeruns'],
+    'STOLEN_BASE': 0,
+    'UNKNOWN': 0,
+}
+# Integer ids for event types, as stored in the slim events cache. These are
+# persisted, so new event types must only ever be added at the end.
+EVENT_ID = {event: i for i, event in enumerate(EVENT_DELTA)}
+EVENT_ID_DELTA = list(EVENT_DELTA.values())
+
+
+# The fields of a game the model uses, with teams also given integer ids
+Game = collections.namedtuple('Game', ['id', 'season', 'day',
+                                       'away_team', 'home_team', 'away_id', 'home_id',
+                                       'away_score', 'home_score', 'away_odds', 'home_odds'])
+
+
+class RollingScore:
+    """
+    Keeps the last `size` game scores for a pitcher or team, along with their
+    running total so the mean doesn't have to re-sum the window.
+    """
+
+    def __init__(self, size):
+        self.scores = collections.deque(maxlen=size)
+        self.total = 0
+
+    def push(self, score):
+        if len(self.scores) == self.scores.maxlen:
+            self.total -= self.scores[0]
+        self.scores.append(score)
+        self.total += score
+
+    def mean(self):
+        return self.total / len(self.scores)
+
+
+# indexed by team id, see index_teams()
+ratings = []
+team_rgs = []
+pitcher_rgs = collections.defaultdict(lambda: RollingScore(model['playerRgs']))
+# game id -> raw game scores, see prefetch_raw_game_scores()
+raw_game_scores = {}
 
 
 def expected(rating_away, rating_home):
-    q_away = math.pow(10, rating_away / 400)
-    q_home = math.pow(10, rating_home / 400)
-    return (q_away / (q_away + q_home), q_home / (q_away + q_home))
+    # q_home / q_away, so only one power is needed per expectation
+    q = 10 ** ((rating_home - rating_away) / 400)
+    expected_away = 1 / (1 + q)
+    return (expected_away, 1 - expected_away)
 
 
 def observed(game):
-    observed_away = int(game['awayScore'] > game['homeScore'])
+    observed_away = int(game.away_score > game.home_score)
     return (observed_away, 1 - observed_away)
 
 
@@ -55,18 +121,46 @@ def calculate_elo(game):
     Calculates and stores the new Elo for the two teams in a game, then returns
     the old Elo for testing the model.
     """
-    rating_away = ratings[game['awayTeam']]
-    rating_home = ratings[game['homeTeam']]
+    away_id = game.away_id
+    home_id = game.home_id
+    rating_away = ratings[away_id]
+    rating_home = ratings[home_id]
 
     expected_away, expected_home = expected(rating_away, rating_home)
     observed_away, observed_home = observed(game)
 
-    ratings[game['awayTeam']] += model['K'] * (observed_away - expected_away)
-    ratings[game['homeTeam']] += model['K'] * (observed_home - expected_home)
+    # the home team's expected and observed results are the away team's
+    # complements, so it moves by exactly the opposite amount
+    delta = K * (observed_away - expected_away)
+    ratings[away_id] = rating_away + delta
+    ratings[home_id] = rating_home - delta
 
     return (rating_away, rating_home)
 
 
+def loads(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+
+def read_json(path):
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def read_cache(path):
+    """
+    Reads a gzipped JSON cache file, raising FileNotFoundError if it is missing.
+    """
+    with open(path, 'rb') as f:
+        return loads(gzip.decompress(f.read()))
+
+
+def write_cache(path, data):
+    raw = orjson.dumps(data) if orjson else json.dumps(data).encode()
+    with open(path, 'wb') as f:
+        f.write(gzip.compress(raw, compresslevel=6))
+
+
 def cache_request(key, url, transform):
     try:
         os.makedirs('cache')
@@ -76,111 +170,224 @@ def cache_request(key, url, transform):
     path = os.path.join('cache', f'{key}.json.gz')
 
     try:
-        f = gzip.open(path, 'rt')
+        data = read_cache(path)
     except FileNotFoundError:
-        with urlopen(url) as request:
-            data = transform(json.load(request))
-            with gzip.open(path, 'wt') as f:
-                json.dump(data, f)
-    else:
-        data = json.load(f)
-        f.close()
+        with urlopen(url, timeout=30) as request:
+            data = transform(loads(request.read()))
+        write_cache(path, data)
 
     return data
 
 
-def game_score(game):
+def cache_events(game_id):
     """
-    Calculates and stores the game scores for both starting pitchers of a game.
-    Returns the rating adjustments.
+    Returns the starting pitcher for each team and the event type ids for a
+    game, trimmed down from the full events cache so later runs only have to
+    decode a short list of ints.
     """
+    try:
+        os.makedirs(os.path.join('cache', 'events_slim'))
+    except FileExistsError:
+        pass
+
+    path = os.path.join('cache', 'events_slim', f'{game_id}.json.gz')
+
+    try:
+        data = read_cache(path)
+    except FileNotFoundError:
+        events = cache_request(game_id,
+                               'https://api.blaseball-reference.com/v1/events?gameId=' + game_id,
+                               lambda data: sorted(data['results'], key=lambda x: x['event_index']))
+        events = [event for event in events if event['pitcher_id']]
+
+        pitchers = {}
+        event_type_ids = []
+        for event in events:
+            pitchers.setdefault(event['pitcher_team_id'], event['pitcher_id'])
+            try:
+                event_type_ids.append(EVENT_ID[event['event_type']])
+            except KeyError:
+                raise ValueError(f'unknown event type "{event["event_type"]}"') from None
+
+        data = {'pitcher_by_team': pitchers, 'event_type_ids': event_type_ids}
+        write_cache(path, data)
+
+    return data
+
+
+def has_events(game):
     # start-of-game events prior to season 2 day 39 are unavailable
-    if (game['season'], game['day']) < (1, 38):
+    return (game.season, game.day) >= (1, 38)
+
+
+def prefetch_events(timeline):
+    """
+    Populates the events cache for every game that doesn't have it yet, using
+    a pool of threads so the requests overlap instead of running one by one.
+    """
+    game_ids = [game.id
+                for season, day, games in timeline
+                for game in games
+                if has_events(game)
+                and not os.path.exists(os.path.join('cache', 'events_slim', f'{game.id}.json.gz'))]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+        for _ in executor.map(cache_events, game_ids):
+            pass
+
+
+def raw_game_score(game):
+    """
+    Calculates the game scores for both starting pitchers of a game from its
+    events, without touching the rolling game scores, so it can run on any
+    game in any order. Returns (game id, (away pitcher, home pitcher, away
+    score, home score)).
+    """
+    events = cache_events(game.id)
+    pitchers = events['pitcher_by_team']
+
+    # both sides are scored on the same events, so they are only summed once
+    events_score = sum(map(EVENT_ID_DELTA.__getitem__, events['event_type_ids']))
+
+    # this is not quite perfect if the pitcher is replaced mid-game, but so
+    # far when that happened they're never to be seen again...
+    away_score = model['gamescore']['base'] + game.home_score * model['gamescore']['runs'] + events_score
+    home_score = model['gamescore']['base'] + game.away_score * model['gamescore']['runs'] + events_score
+
+    return (game.id, (pitchers[game.away_team], pitchers[game.home_team], away_score, home_score))
+
+
+def prefetch_raw_game_scores(timeline):
+    """
+    Calculates the raw game scores of every game with events on a pool of
+    processes, ahead of the replay folding them into the rolling game scores.
+    """
+    games = [game for season, day, games in timeline for game in games if has_events(game)]
+
+    with multiprocessing.Pool() as pool:
+        raw_game_scores.update(pool.imap_unordered(raw_game_score, games, chunksize=64))
+
+
+def game_score(game):
+    """
+    Stores the game scores for both starting pitchers of a game in the rolling
+    game scores. Returns the rating adjustments.
+    """
+    if not has_events(game):
         return (0, 0)
 
-    events = cache_request(game['id'],
-                           'https://api.blaseball-reference.com/v1/events?gameId=' + game['id'],
-                           lambda data: sorted(data['results'], key=lambda x: x['event_index']))
+    try:
+        away_pitcher, home_pitcher, away_score, home_score = raw_game_scores[game.id]
+    except KeyError:
+        away_pitcher, home_pitcher, away_score, home_score = raw_game_score(game)[1]
 
     adj = {}
-    for which in ['away', 'home']:
-        team = game[f'{which}Team']
-        pitcher = next(event['pitcher_id'] for event in events if event['pitcher_team_id'] == team)
-        events = list(filter(lambda event: event['pitcher_id'], events))
-
-        score = model['gamescore']['base']
-        opponent = {'away': 'home', 'home': 'away'}[which]
-        # this is not quite perfect if the pitcher is replaced mid-game, but so
-        # far when that happened they're never to be seen again...
-        score += game[f'{opponent}Score'] * model['gamescore']['runs']
-
-        for event in (e['event_type'] for e in events):
-            if event == 'STRIKEOUT':
-                score += model['gamescore']['strikeouts'] + model['gamescore']['outs']
-            elif event in ['CAUGHT_STEALING', 'OUT']:
-                score += model['gamescore']['outs']
-            elif event == 'WALK':
-                score += model['gamescore']['walks'] + model['gamescore']['hits']
-            elif event in ['SINGLE', 'DOUBLE', 'TRIPLE']:
-                score += model['gamescore']['hits']
-            elif event in ['FIELDERS_CHOICE']:
-                score += model['gamescore']['outs'] + model['gamescore']['hits']
-            elif event == 'HOME_RUN':
-                score += model['gamescore']['homeruns']
-            elif event in ['STOLEN_BASE', 'UNKNOWN']:
-                pass
-            else:
-                raise ValueError(f'unknown event type "{event}"')
-
-        rgs[pitcher].append(score)
-        rgs[pitcher] = rgs[pitcher][-model['playerRgs']:]
-        rgs[team].append(score)
-        rgs[team] = rgs[team][-model['teamRgs']:]
-
-        adj[which] = model['gsMult'] * (sum(rgs[pitcher]) / len(rgs[pitcher])
-                                      - sum(rgs[team]) / len(rgs[team]))
+    for which, team_id, pitcher, score in [('away', game.away_id, away_pitcher, away_score),
+                                           ('home', game.home_id, home_pitcher, home_score)]:
+        pitcher_rgs[pitcher].push(score)
+        team_rgs[team_id].push(score)
+
+        adj[which] = model['gsMult'] * (pitcher_rgs[pitcher].mean() - team_rgs[team_id].mean())
 
     return (adj['away'], adj['home'])
 
 
 def error(expected, observed):
-    return math.pow(expected - observed, 2)
+    return (expected - observed) ** 2
 
 
 def revert_to_mean():
-    for team, rating in ratings.items():
-        ratings[team] = (model['seasonRevertFactor'] * model['mean'] +
-                         (1 - model['seasonRevertFactor']) * rating)
+    ratings[:] = [REVERT_BIAS + REVERT_SCALE * rating for rating in ratings]
+
+
+def load_timeline():
+    """
+    Loads every day of game data, reading the files on a pool of threads, and
+    returns a list of (season, day, games) in order.
+    """
+    paths = []
+    dirs = ['game-data']
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                else:
+                    paths.append(entry.path)
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        timeline = [(data[0]['season'], data[0]['day'], data)
+                    for data in executor.map(read_json, paths)]
+
+    timeline.sort(key=operator.itemgetter(0, 1))
+    return timeline
+
+
+def index_teams(timeline):
+    """
+    Gives every team an integer id, replaces each day's game data with Game
+    records carrying those ids, and starts every team's rating at the mean
+    with an empty rolling game score.
+    """
+    teams = sorted({game[f'{which}Team']
+                    for season, day, games in timeline
+                    for game in games
+                    for which in ['away', 'home']})
+    team_ids = {team: i for i, team in enumerate(teams)}
+
+    for i, (season, day, games) in enumerate(timeline):
+        timeline[i] = (season, day, [Game(game['id'], game['season'], game['day'],
+                                          game['awayTeam'], game['homeTeam'],
+                                          team_ids[game['awayTeam']], team_ids[game['homeTeam']],
+                                          game['awayScore'], game['homeScore'],
+                                          game['awayOdds'], game['homeOdds'])
+                                     for game in games])
+
+    ratings[:] = [MEAN] * len(teams)
+    team_rgs[:] = [RollingScore(model['teamRgs']) for team in teams]
+
+
+def run_season(days):
+    """
+    Runs every game of a season's (season, day, games) entries in order,
+    updating ratings as it goes, and returns the season's analysis of our
+    predictions against the official odds.
+    """
+    sibr_count = sibr_correct = sibr_error = 0
+    official_count = official_correct = official_error = 0
+
+    for season, day, games in days:
+        for game in games:
+            rating_away, rating_home = calculate_elo(game)
+            adj_away, adj_home = game_score(game)
+            expected_away, _ = expected(rating_away + adj_away, rating_home + adj_home)
+            observed_away, observed_home = observed(game)
+
+            sibr_count += 1
+            sibr_correct += abs(expected_away - observed_away) < 0.5
+            # our home expectation and the home result are the away ones'
+            # complements, so both sides contribute the same error
+            sibr_error += 2 * error(expected_away, observed_away)
+
+            if game.away_odds != game.home_odds:
+                official_count += 1
+                official_correct += abs(game.away_odds - observed_away) < 0.5
+                official_error += error(game.away_odds, observed_away) + error(game.home_odds, observed_home)
+
+    return {'sibr': {'count': sibr_count, 'correct': sibr_correct, 'error': sibr_error},
+            'official': {'count': official_count, 'correct': official_correct, 'error': official_error}}
 
 
 if __name__ == '__main__':
-    seasons = collections.defaultdict(dict)
-    for root, dirs, files in os.walk('game-data'):
-        for filename in files:
-            with open(os.path.join(root, filename)) as f:
-                data = json.load(f)
-            seasons[data[0]['season']][data[0]['day']] = data
-
-    analysis = collections.defaultdict(lambda: {'sibr': {'count': 0, 'correct': 0, 'error': 0},
-                                                'official': {'count': 0, 'correct': 0, 'error': 0}})
-
-    for season, days in sorted(seasons.items()):
-        for day, games in sorted(days.items()):
-            for game in games:
-                rating_away, rating_home = calculate_elo(game)
-                adj_away, adj_home = game_score(game)
-                expected_away, expected_home = expected(rating_away + adj_away, rating_home + adj_home)
-                observed_away, observed_home = observed(game)
-
-                analysis[season]['sibr']['count'] += 1
-                analysis[season]['sibr']['correct'] += int(abs(expected_away - observed_away) < 0.5)
-                analysis[season]['sibr']['error'] += error(expected_away, observed_away) + error(expected_home, observed_home)
-
-                if game['awayOdds'] != game['homeOdds']:
-                    analysis[season]['official']['count'] += 1
-                    analysis[season]['official']['correct'] += int(abs(game['awayOdds'] - observed_away) < 0.5)
-                    analysis[season]['official']['error'] += error(game['awayOdds'], observed_away) + error(game['homeOdds'], observed_home)
+    timeline = load_timeline()
+    index_teams(timeline)
+
+    prefetch_events(timeline)
+    prefetch_raw_game_scores(timeline)
 
+    analysis = {}
+    for season, days in itertools.groupby(timeline, key=operator.itemgetter(0)):
+        analysis[season] = run_season(days)
         revert_to_mean()
 
     for season, data in analysis.items():